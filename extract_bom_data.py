@@ -5,62 +5,132 @@
 """
 
 import os
+import re
 import json
+import sys
+import logging
+import asyncio
+import hashlib
+import tempfile
+import queue
+import multiprocessing
+import threading
+from multiprocessing import shared_memory
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+import aiohttp
+import numpy as np
 from openpyxl import load_workbook
 from tqdm import tqdm
-import pdfplumber
 import uuid
 # 核心修正：這裡的名字必須與 utils.py 裡的 AzureOpenAIAPI 完全一致
-from utils import GeminiAPI, AzureOpenAIAPI, load_config, print_progress
+from utils import GeminiAPI, AzureOpenAIAPI, load_config, print_progress, encode_vector
+
+# pymupdf 在模組載入時就匯入，避免第一份 PDF 才付出匯入成本
+try:
+    import fitz  # pymupdf
+except ImportError:
+    fitz = None
 
 # OCR 相關套件（延遲載入，避免沒用到時報錯）
 ocr_reader = None
+_ocr_reader_lock = threading.Lock()
+# 每個 OCR 行程可用的執行緒數（多行程時要分攤 CPU，避免超額訂閱）
+_ocr_threads = None
+
+# 內容雜湊 → model_hint，內容沒變的檔案不必再呼叫 Gemini
+# （向量由 utils.EmbeddingCache 依「部署名稱 + 文字」快取，這裡不重複存）
+MODEL_HINT_CACHE_FILE = 'model_hint_cache.json'
+
+# 含半形或全形 # 字號的列判定為零件項
+_HASH_RE = re.compile(r'[#＃]')
+# OCR 轉圖倍率；某頁辨識出的文字太少時，只針對該頁改用較高倍率重試
+OCR_ZOOM = 1.5
+OCR_RETRY_ZOOM = 2.0
+OCR_MIN_PAGE_CHARS = 30
+
+# Numbers 轉換說明的工作表（同時出現 Numbers 與「輸出」，或出現「此文件從」）；儲存格內可能換行，需 DOTALL
+_NUMBERS_NOTE_RE = re.compile(r'Numbers.*輸出|輸出.*Numbers|此文件從', re.DOTALL)
+
+# 同時進行中的 API 請求上限（避免觸發 Gemini / Azure 的流量限制）
+MAX_CONCURRENT_REQUESTS = 20
 
 def get_ocr_reader():
-    """延遲載入 EasyOCR（第一次使用時才載入，節省啟動時間）"""
+    """延遲載入 OCR 引擎（第一次使用時才載入，節省啟動時間）
+
+    優先使用 RapidOCR（ONNX Runtime，CPU 上比 EasyOCR 快數倍），沒安裝時改用 EasyOCR
+    """
     global ocr_reader
-    if ocr_reader is None:
-        print("[INFO] 首次載入 OCR 模型，請稍候...")
-        import easyocr
-        ocr_reader = easyocr.Reader(['ch_tra', 'en'], gpu=False)  # 繁體中文 + 英文
-        print("[INFO] OCR 模型載入完成")
+    # 預熱執行緒與處理執行緒可能同時呼叫，用鎖確保只載入一次
+    with _ocr_reader_lock:
+        if ocr_reader is None:
+            print("[INFO] 首次載入 OCR 模型，請稍候...")
+            threads = _ocr_threads or os.cpu_count() or 1
+            try:
+                from rapidocr_onnxruntime import RapidOCR
+                ocr_reader = RapidOCR(intra_op_num_threads=threads)
+            except ImportError:
+                import easyocr
+                import torch
+                # EasyOCR 用 torch 推論，預設會佔用所有核心，同樣依行程數分攤
+                torch.set_num_threads(threads)
+                ocr_reader = easyocr.Reader(['ch_tra', 'en'], gpu=False)  # 繁體中文 + 英文
+            print(f"[INFO] OCR 模型載入完成（{type(ocr_reader).__name__}）")
     return ocr_reader
 
+def _set_ocr_threads(num_workers):
+    """依行程數平分 CPU 給每個行程的 OCR 引擎"""
+    global _ocr_threads
+    _ocr_threads = max(1, (os.cpu_count() or 1) // max(1, num_workers))
+
+def _warm_up_worker(warm_up_slots, num_workers):
+    """子行程初始化：還有預熱名額時，在背景執行緒預先載入 OCR 模型
+
+    warm_up_slots 是跨行程共用的計數（multiprocessing.Value），最多只有 PDF 數個行程預熱，
+    其餘行程遇到 PDF 時才載入，避免少數 PDF 讓每個行程都各載一份模型
+    """
+    _set_ocr_threads(num_workers)
+    with warm_up_slots.get_lock():
+        if warm_up_slots.value <= 0:
+            return
+        warm_up_slots.value -= 1
+    threading.Thread(target=get_ocr_reader, daemon=True).start()
+
 def extract_bom_text_from_excel(excel_path):
     """提取 Excel 中的文字（支援 Numbers 轉換的檔案）"""
     try:
-        wb = load_workbook(excel_path, data_only=True)
-        all_text = ""
+        # read_only 模式使用串流讀取，不會為每個儲存格建立 Cell 物件
+        wb = load_workbook(excel_path, data_only=True, read_only=True)
+        all_text_parts = []
         bom_items = []
         
         # 遍歷所有工作表（Numbers 轉換可能產生多個工作表）
         for sheet in wb.worksheets:
-            sheet_text = ""
+            sheet_parts = []
             
-            for row in range(1, sheet.max_row + 1):
-                row_vals = []
-                for col in range(1, sheet.max_column + 1):
-                    val = sheet.cell(row, col).value
-                    if val:
-                        row_vals.append(str(val).strip())
+            for row_vals in sheet.iter_rows(values_only=True):
+                row_vals = [str(val).strip() for val in row_vals if val]
                 
                 line_text = " ".join(row_vals)
                 if line_text:
-                    sheet_text += line_text + " "
+                    sheet_parts.append(line_text)
                     # 如果有 # 字號，判定為零件項
-                    if "#" in line_text or "＃" in line_text:
+                    if _HASH_RE.search(line_text):
                         bom_items.append({
                             "number": row_vals[0] if row_vals else "", 
                             "full_text": line_text
                         })
             
+            sheet_text = " ".join(sheet_parts)
+            
             # 跳過 Numbers 轉換說明的工作表
-            if "Numbers" in sheet_text and "輸出" in sheet_text:
-                continue
-            if "此文件從" in sheet_text:
+            if _NUMBERS_NOTE_RE.search(sheet_text):
                 continue
-                
-            all_text += sheet_text
+            
+            if sheet_text:
+                all_text_parts.append(sheet_text)
+        
+        wb.close()
+        all_text = " ".join(all_text_parts)
         
         return {
             'filename': os.path.basename(excel_path),
@@ -74,19 +144,26 @@ def extract_bom_text_from_excel(excel_path):
 def extract_bom_text_from_pdf(pdf_path):
     """提取 PDF 中的文字（支援掃描型 PDF）"""
     try:
-        all_text = ""
+        if fitz is None:
+            print("❌ 缺少 pymupdf 套件，請執行：pip install pymupdf")
+            return None
         
-        # 第一步：嘗試用 pdfplumber 提取文字（適用於文字型 PDF）
-        with pdfplumber.open(pdf_path) as pdf:
-            for page in pdf.pages:
-                text = page.extract_text()
+        # 第一步：用 pymupdf 直接提取文字（適用於文字型 PDF）
+        doc = fitz.open(pdf_path)
+        try:
+            page_texts = []
+            for page in doc:
+                text = page.get_text()
                 if text: 
-                    all_text += text + "\n"
-        
-        # 第二步：如果提取的文字太少，可能是掃描型 PDF，改用 OCR
-        if len(all_text.strip()) < 50:
-            print(f"⚠️  [{os.path.basename(pdf_path)}] 文字太少，嘗試 OCR...")
-            all_text = extract_text_with_ocr(pdf_path)
+                    page_texts.append(text)
+            all_text = "\n".join(page_texts)
+            
+            # 第二步：如果提取的文字太少，可能是掃描型 PDF，沿用同一份 doc 改用 OCR
+            if len(all_text.strip()) < 50:
+                print(f"⚠️  [{os.path.basename(pdf_path)}] 文字太少，嘗試 OCR...")
+                all_text = extract_text_with_ocr(doc)
+        finally:
+            doc.close()
         
         return {
             'filename': os.path.basename(pdf_path),
@@ -98,40 +175,200 @@ def extract_bom_text_from_pdf(pdf_path):
         return None
 
 
-def extract_text_with_ocr(pdf_path):
-    """使用 OCR 從掃描型 PDF 提取文字"""
+def _render_page(doc, page_num, zoom=OCR_ZOOM):
+    """把 PDF 頁面轉成灰階 numpy 像素陣列 (高, 寬)，省去 PNG 編碼再解碼"""
+    page = doc.load_page(page_num)
+    # 灰階只有 1 個通道，BOM 文字在 1.5 倍解析度下通常就足夠辨識
+    mat = fitz.Matrix(zoom, zoom)
+    pix = page.get_pixmap(matrix=mat, colorspace=fitz.csGRAY, alpha=False)
+    return np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.width)
+
+
+def _ocr_image(img_data):
+    """OCR 一張圖片，回傳該頁文字"""
+    # 每個行程第一次呼叫時才載入 OCR 模型，之後的頁面共用同一個 reader
+    reader = get_ocr_reader()
+
+    if hasattr(reader, 'readtext'):
+        # EasyOCR
+        results = reader.readtext(img_data)
+    else:
+        # RapidOCR：回傳 (結果, 耗時)，沒有辨識到文字時結果是 None
+        results, _ = reader(img_data)
+        results = results or []
+
+    # 提取文字（兩者的每筆結果都是 [框, 文字, 信心值]），略過空白的辨識結果
+    texts = (result[1].strip() for result in results)
+    return " ".join(text for text in texts if text)
+
+
+def _ocr_shared_page(shm_name, shape):
+    """OCR 放在共享記憶體中的頁面圖片（在子行程中執行，因此必須是模組層級函式才能 pickle）"""
+    shm = shared_memory.SharedMemory(name=shm_name)
     try:
-        import fitz  # pymupdf
-        
-        all_text = ""
-        reader = get_ocr_reader()
-        
-        # 打開 PDF
-        doc = fitz.open(pdf_path)
-        total_pages = len(doc)
-        
-        print(f"[INFO] 開始 OCR 處理 {total_pages} 頁...")
-        
-        for page_num in range(total_pages):
-            # 把 PDF 頁面轉成圖片
-            page = doc.load_page(page_num)
-            # 提高解析度以獲得更好的 OCR 效果
-            mat = fitz.Matrix(2.0, 2.0)  # 放大 2 倍
-            pix = page.get_pixmap(matrix=mat)
-            
-            # 轉成 PIL Image
-            img_data = pix.tobytes("png")
-            
-            # 使用 EasyOCR 辨識
-            results = reader.readtext(img_data)
+        # 直接在共享記憶體上建立陣列，不複製像素
+        img = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        try:
+            return _ocr_image(img)
+        finally:
+            # 關閉共享記憶體前必須先釋放指向它的陣列
+            del img
+    finally:
+        shm.close()
+
+
+def _release_page(shm):
+    """釋放一頁圖片佔用的共享記憶體"""
+    shm.close()
+    shm.unlink()
+
+
+def _to_shared_memory(img):
+    """把頁面陣列複製到新的共享記憶體區塊"""
+    shm = shared_memory.SharedMemory(create=True, size=max(1, img.nbytes))
+    np.ndarray(img.shape, dtype=np.uint8, buffer=shm.buf)[:] = img
+    return shm
+
+
+def _needs_retry(page_text):
+    """該頁辨識出的文字太少，可能是解析度不足"""
+    return len(page_text.strip()) < OCR_MIN_PAGE_CHARS
+
+
+def _ocr_pages_parallel(doc, total_pages, max_workers):
+    """背景執行緒負責轉圖，行程池負責 OCR；回傳依頁碼排序的文字"""
+    # 有上限的佇列：OCR 跟不上時，轉圖執行緒會暫停，避免圖片堆滿記憶體
+    rendered = queue.Queue(maxsize=8)
+    stop = threading.Event()
+    render_errors = []
+
+    def render_pages():
+        # 這裡只轉圖；共享記憶體由主執行緒建立。SharedMemory(create=True) 會持有
+        # resource_tracker 的鎖，若此時主執行緒送出工作而 fork 出子行程，子行程會卡死
+        try:
+            for page_num in range(total_pages):
+                if stop.is_set():
+                    break
+                rendered.put((page_num, _render_page(doc, page_num)))
+        except Exception as e:
+            render_errors.append(e)
+        finally:
+            rendered.put(None)
+
+    renderer = threading.Thread(target=render_pages, daemon=True)
+    renderer.start()
+
+    page_texts = [""] * total_pages
+    retry_pages = []
+    pending = {}
+    done_count = 0
+
+    def collect(futures):
+        nonlocal done_count
+        for future in futures:
+            page_num, shm, is_retry = pending.pop(future)
+            try:
+                # 先等子行程處理完，才能釋放它正在讀取的共享記憶體
+                page_text = future.result()
+            except Exception as e:
+                if not is_retry:
+                    raise
+                # 重試失敗時保留原本倍率的結果
+                print(f"⚠️  第 {page_num + 1} 頁高倍率重試失敗，沿用原結果: {e}")
+                continue
+            finally:
+                _release_page(shm)
+            if is_retry:
+                # 高倍率的結果比較長才採用
+                if len(page_text.strip()) > len(page_texts[page_num].strip()):
+                    page_texts[page_num] = page_text
+                continue
+            page_texts[page_num] = page_text
+            if _needs_retry(page_text):
+                retry_pages.append(page_num)
+            done_count += 1
+            print(f"  ✓ 第 {page_num + 1}/{total_pages} 頁 OCR 完成（{done_count}/{total_pages}）")
+
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers, initializer=_set_ocr_threads,
+                                 initargs=(max_workers,)) as executor:
+            while True:
+                item = rendered.get()
+                if item is None:
+                    break
+                page_num, img = item
+                shm = _to_shared_memory(img)
+                pending[executor.submit(_ocr_shared_page, shm.name, img.shape)] = (page_num, shm, False)
+                # 同時在處理中的頁數也設上限
+                if len(pending) >= max_workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(list(pending))
             
-            # 提取文字
-            page_text = " ".join([result[1] for result in results])
-            all_text += page_text + "\n"
+            # 轉圖執行緒已結束，由主執行緒以較高倍率重新轉圖
+            if retry_pages:
+                print(f"[INFO] {len(retry_pages)} 頁文字太少，改用 {OCR_RETRY_ZOOM} 倍解析度重試...")
+            for page_num in sorted(retry_pages):
+                img = _render_page(doc, page_num, zoom=OCR_RETRY_ZOOM)
+                shm = _to_shared_memory(img)
+                pending[executor.submit(_ocr_shared_page, shm.name, img.shape)] = (page_num, shm, True)
+                if len(pending) >= max_workers * 2:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    collect(done)
+            collect(list(pending))
+    finally:
+        # 發生錯誤時讓轉圖執行緒結束（清空佇列讓它不會卡在 put），並釋放所有尚未處理的共享記憶體
+        stop.set()
+        while renderer.is_alive() or not rendered.empty():
+            try:
+                rendered.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        for _, shm, _ in pending.values():
+            _release_page(shm)
+
+    if render_errors:
+        raise render_errors[0]
+    return page_texts
+
+
+def extract_text_with_ocr(pdf):
+    """使用 OCR 從掃描型 PDF 提取文字（轉圖與多行程 OCR 同時進行）
+
+    pdf 可以是檔案路徑，或已經開啟的 fitz.Document（由呼叫端負責關閉）
+    """
+    try:
+        if fitz is None:
+            raise ImportError("pymupdf")
+        
+        # 傳入路徑時才自行開啟 PDF
+        owns_doc = isinstance(pdf, (str, os.PathLike))
+        doc = fitz.open(pdf) if owns_doc else pdf
+        try:
+            total_pages = len(doc)
             
-            print(f"  ✓ 第 {page_num + 1}/{total_pages} 頁 OCR 完成")
+            # 已經在 process_all_files 的子行程裡時，不再開巢狀行程池，逐頁處理即可
+            if multiprocessing.parent_process() is not None:
+                print(f"[INFO] 開始 OCR 處理 {total_pages} 頁...")
+                page_texts = []
+                for page_num in range(total_pages):
+                    page_text = _ocr_image(_render_page(doc, page_num))
+                    if _needs_retry(page_text):
+                        retry_text = _ocr_image(_render_page(doc, page_num, zoom=OCR_RETRY_ZOOM))
+                        if len(retry_text.strip()) > len(page_text.strip()):
+                            page_text = retry_text
+                    page_texts.append(page_text)
+                    print(f"  ✓ 第 {page_num + 1}/{total_pages} 頁 OCR 完成")
+            else:
+                max_workers = max(1, min(os.cpu_count() or 1, 4, total_pages))
+                print(f"[INFO] 開始 OCR 處理 {total_pages} 頁（{max_workers} 個行程）...")
+                page_texts = _ocr_pages_parallel(doc, total_pages, max_workers)
+        finally:
+            if owns_doc:
+                doc.close()
+        
+        all_text = "\n".join(page_texts)
         
-        doc.close()
         print(f"✅ OCR 完成，提取 {len(all_text)} 字元")
         
         return all_text
@@ -143,13 +380,121 @@ def extract_text_with_ocr(pdf_path):
         print(f"❌ OCR Error: {e}")
         return ""
 
-def process_all_files(history_folder, output_json='extracted_data.json'):
-    """批量處理檔案並生成向量存入 JSON"""
-    config = load_config()
+def load_model_hint_cache(cache_file=MODEL_HINT_CACHE_FILE):
+    """讀取型號快取，檔案不存在或損毀時回傳空的快取"""
+    if not os.path.exists(cache_file):
+        return {}
+    try:
+        with open(cache_file, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        print(f"⚠️  型號快取讀取失敗，將重新建立: {e}")
+        return {}
+
+def save_model_hint_cache(cache, cache_file=MODEL_HINT_CACHE_FILE):
+    """先寫入暫存檔再 os.replace，避免中途中斷留下寫一半的快取"""
+    cache_dir = os.path.dirname(os.path.abspath(cache_file))
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(cache, f, ensure_ascii=False)
+        os.replace(tmp_path, cache_file)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+def _extract_one(file_path):
+    """提取單一檔案的文字（CPU 密集，在子行程中執行）"""
+    if file_path.endswith('.pdf'):
+        return extract_bom_text_from_pdf(file_path)
+    return extract_bom_text_from_excel(file_path)
+
+async def _process_one(file_path, executor, model_hint_cache, azure_ai, gemini, session, semaphore):
+    """處理單一檔案：子行程提取文字 → 同時呼叫 Gemini 取型號、Azure 取向量
+
+    回傳 (內容雜湊, 要寫入 JSON 的 doc)，失敗時 doc 為 None；型號不可靠（不該快取）時內容雜湊為 None
+    """
+    loop = asyncio.get_running_loop()
+    data = await loop.run_in_executor(executor, _extract_one, file_path)
+        
+    if not data or not data['full_text']:
+        return None, None
+    
+    key = hashlib.sha256(data['full_text'].encode('utf-8')).hexdigest()
+    model_hint = model_hint_cache.get(key)
+    hint_ok = True
+    
+    async with semaphore:
+        # 2. 用完整 BOM 內容生成向量（重要！查詢時也用 full_text）
+        #    內容與部署沒變時會直接命中 EmbeddingCache，不呼叫 Azure
+        embedding = azure_ai.get_embedding_async(session, data['full_text'])
+        if model_hint is not None:
+            # 內容沒變，直接沿用上次的型號
+            vector = await embedding
+        else:
+            # 1. 提取型號（用於顯示和輔助搜尋）
+            (model_hint, hint_ok), vector = await asyncio.gather(
+                gemini.model_hint_async(session, data['full_text']),
+                embedding
+            )
+    
+    if not hint_ok:
+        # Gemini 失敗時的備用型號不寫入快取，下次執行會重新提取
+        key = None
+    if vector is None:
+        return key, None
+    vector = encode_vector(vector)  # float32 + base64，縮小 JSON
+    
+    return key, {
+        'document_id': str(uuid.uuid4()),
+        'filename': data['filename'],
+        'bom_items': data['bom_items'],
+        'full_text': data['full_text'],
+        'model_hint': model_hint,  # 額外儲存型號提示
+        'vector': vector,
+        'is_primary': True
+    }
+
+async def _process_all_async(all_files, model_hint_cache):
+    """文字提取丟給行程池，API 呼叫用 asyncio 同時進行，兩者互相重疊"""
     # 這裡會呼叫 utils.py 裡的類別
     azure_ai = AzureOpenAIAPI()
     gemini = GeminiAPI()
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    
+    # 有 PDF 時讓最多 PDF 數個子行程一啟動就在背景載入 OCR 模型，與 Excel 處理重疊
+    num_pdfs = sum(1 for f in all_files if f.endswith('.pdf'))
+    max_workers = min(os.cpu_count() or 1, len(all_files))
+    warm_up_slots = multiprocessing.Value('i', min(num_pdfs, max_workers))
     
+    all_data = []
+    with ProcessPoolExecutor(max_workers=max_workers, initializer=_warm_up_worker,
+                             initargs=(warm_up_slots, max_workers)) as executor:
+        async with aiohttp.ClientSession() as session:
+            tasks = [asyncio.ensure_future(_process_one(f, executor, model_hint_cache, azure_ai,
+                                                        gemini, session, semaphore))
+                     for f in all_files]
+            names = {task: os.path.basename(f) for task, f in zip(tasks, all_files)}
+            with tqdm(total=len(all_files), desc="Processing files") as pbar:
+                pending = set(tasks)
+                while pending:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        pbar.update(1)
+                        try:
+                            key, doc = task.result()
+                        except Exception as e:
+                            print(f"❌ 處理失敗 ({names[task]}): {e}")
+                            continue
+                        if doc:
+                            all_data.append(doc)
+                            if key:
+                                model_hint_cache[key] = doc['model_hint']
+                            print(f"  ✓ {doc['filename']} (型號: {doc['model_hint']})")
+    return all_data
+
+def process_all_files(history_folder, output_json='extracted_data.json'):
+    """批量處理檔案並生成向量存入 JSON（多行程提取文字 + 非同步呼叫 API）"""
     all_files = [os.path.join(history_folder, f) for f in os.listdir(history_folder) 
                  if f.endswith(('.xlsx', '.xls', '.pdf'))]
     
@@ -157,34 +502,16 @@ def process_all_files(history_folder, output_json='extracted_data.json'):
         print(f"❌ 資料夾內找不到任何支援的檔案: {history_folder}")
         return []
 
-    all_data = []
-    for file_path in tqdm(all_files, desc="Processing files"):
-        if file_path.endswith('.pdf'):
-            data = extract_bom_text_from_pdf(file_path)
-        else:
-            data = extract_bom_text_from_excel(file_path)
-            
-        if data and data['full_text']:
-            # 1. 提取型號（用於顯示和輔助搜尋）
-            model_hint = gemini.enhance_bom_text(data['full_text'])
-            
-            # 2. 用完整 BOM 內容生成向量（重要！查詢時也用 full_text）
-            vector = azure_ai.get_embedding(data['full_text'])
-            
-            if vector:
-                doc = {
-                    'document_id': str(uuid.uuid4()),
-                    'filename': data['filename'],
-                    'bom_items': data['bom_items'],
-                    'full_text': data['full_text'],
-                    'model_hint': model_hint,  # 額外儲存型號提示
-                    'vector': vector,
-                    'is_primary': True
-                }
-                all_data.append(doc)
-                print(f"  ✓ {data['filename']} (型號: {model_hint})")
+    model_hint_cache = load_model_hint_cache()
+    cache_size = len(model_hint_cache)
+
+    all_data = asyncio.run(_process_all_async(all_files, model_hint_cache))
+    
+    # 有新的型號才更新快取
+    if len(model_hint_cache) > cache_size:
+        save_model_hint_cache(model_hint_cache)
             
-    # 儲存結果
+    # 儲存結果（只在主行程寫檔）
     with open(output_json, 'w', encoding='utf-8') as f:
         json.dump(all_data, f, ensure_ascii=False, indent=2)
     
@@ -192,6 +519,8 @@ def process_all_files(history_folder, output_json='extracted_data.json'):
     return all_data
 
 if __name__ == '__main__':
+    # utils 的訊息改用 logging 輸出，這裡決定等級（要看 [DEBUG] 訊息時改成 logging.DEBUG）
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
     config = load_config()
     history_folder = config['PATHS']['history_excel_folder']
     process_all_files(history_folder)
\ No newline at end of file
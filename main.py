@@ -6,6 +6,7 @@ BOM RAG 系統 - 主程式（僅文字版本，無圖片）
 
 import os
 import sys
+import logging
 from utils import load_config, print_progress
 
 def main():
@@ -121,6 +122,8 @@ def main():
 
 
 if __name__ == '__main__':
+    # utils 的訊息改用 logging 輸出，這裡決定等級（要看 [DEBUG] 訊息時改成 logging.DEBUG）
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
     try:
         success = main()
         if not success:
@@ -1,14 +1,36 @@
 import os
 import sys
+import logging
+import atexit
 from pymongo import MongoClient
 from utils import AzureOpenAIAPI, GeminiAPI, load_config, print_progress
 from openpyxl import Workbook
 from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
 
+# 樣式物件只建立一次，所有儲存格共用
+CENTER = Alignment(horizontal='center', vertical='center')
+LEFT_WRAP = Alignment(horizontal='left', vertical='top', wrap_text=True)
+BORDER = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
+HEADER_FILL = PatternFill(start_color="D9E1F2", end_color="D9E1F2", fill_type="solid")
+HEADER_FONT = Font(bold=True)
+# 每一欄的對齊方式：步驟、標題、照片置中；說明、注意事項靠左換行
+STEP_ALIGNMENTS = (CENTER, CENTER, CENTER, LEFT_WRAP, LEFT_WRAP)
+
+# 整個行程共用一個 MongoClient（內建連線池），避免每次查詢都重新握手
+_client = None
+
+def _get_client(connection_string):
+    """取得共用的 MongoClient，第一次呼叫時才建立"""
+    global _client
+    if _client is None:
+        _client = MongoClient(connection_string, maxPoolSize=10)
+        atexit.register(_client.close)
+    return _client
+
 def query_similar_boms(query_vector, config, top_k=3):
     """用向量相似度搜尋最相似的 BOM 模板"""
     try:
-        client = MongoClient(config['MONGODB']['connection_string'])
+        client = _get_client(config['MONGODB']['connection_string'])
         db = client[config['MONGODB']['database_name']]
         collection = db[config['MONGODB']['collection_name']]
         
@@ -20,7 +42,7 @@ def query_similar_boms(query_vector, config, top_k=3):
                 "$vectorSearch": {
                     "index": config['MONGODB']['vector_index_name'],
                     "path": "vector",
-                    "queryVector": query_vector,
+                    "queryVector": query_vector.tolist(),
                     "numCandidates": 100,
                     "limit": top_k
                 }
@@ -33,7 +55,6 @@ def query_similar_boms(query_vector, config, top_k=3):
                 }
             }
         ]))
-        client.close()
         
         # 印出搜尋結果
         print("\n[向量搜尋結果 - 按相似度排序]:")
@@ -53,9 +74,6 @@ def create_styled_excel(steps, product_name, output_path):
     ws = wb.active
     ws.title = "SOP"
     
-    border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-    header_fill = PatternFill(start_color="D9E1F2", end_color="D9E1F2", fill_type="solid")
-    
     ws.merge_cells('A1:E1')
     ws['A1'] = f"產品組裝指導書 - {product_name}"
     ws['A1'].font = Font(bold=True, size=16)
@@ -65,22 +83,19 @@ def create_styled_excel(steps, product_name, output_path):
     ws.append(headers)
     
     for cell in ws[2]:
-        cell.font = Font(bold=True)
-        cell.fill = header_fill
+        cell.font = HEADER_FONT
+        cell.fill = HEADER_FILL
         cell.alignment = Alignment(horizontal='center')
-        cell.border = border
+        cell.border = BORDER
 
-    row_idx = 3
     for s in steps:
-        ws.cell(row=row_idx, column=1, value=s.get('step_number')).alignment = Alignment(horizontal='center', vertical='center')
-        ws.cell(row=row_idx, column=2, value=s.get('title')).alignment = Alignment(horizontal='center', vertical='center')
-        ws.cell(row=row_idx, column=3, value="[ 預留照片位置 ]").alignment = Alignment(horizontal='center', vertical='center')
-        ws.cell(row=row_idx, column=4, value=s.get('description')).alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
-        ws.cell(row=row_idx, column=5, value=s.get('notes')).alignment = Alignment(horizontal='left', vertical='top', wrap_text=True)
+        ws.append([s.get('step_number'), s.get('title'), "[ 預留照片位置 ]", s.get('description'), s.get('notes')])
+        row_idx = ws.max_row
         
-        for col in range(1, 6): ws.cell(row=row_idx, column=col).border = border
+        for cell, alignment in zip(ws[row_idx], STEP_ALIGNMENTS):
+            cell.alignment = alignment
+            cell.border = BORDER
         ws.row_dimensions[row_idx].height = 180 # 超大照片格
-        row_idx += 1
 
     ws.column_dimensions['A'].width = 8
     ws.column_dimensions['B'].width = 15
@@ -121,7 +136,7 @@ def main():
     # 2. 生成向量並搜尋相似模板
     print_progress("生成向量...")
     vector = azure_ai.get_embedding(data['full_text'])
-    if not vector:
+    if vector is None:
         print("❌ 向量生成失敗。")
         return
     
@@ -150,6 +165,8 @@ def main():
     print(f"🎉 成功！檔案已儲存: {output_path}")
 
 if __name__ == '__main__':
+    # utils 的訊息改用 logging 輸出，這裡決定等級（要看 [DEBUG] 訊息時改成 logging.DEBUG）
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
     try:
         main()
     except Exception as e:
@@ -3,19 +3,62 @@
 將提取的資料上傳到 MongoDB Atlas
 """
 
-import json
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure, OperationFailure
-from utils import load_config, print_progress
+import os
+import atexit
+import hashlib
+import sys
+import logging
+import ijson
+from tqdm import tqdm
+from pymongo import MongoClient, WriteConcern
+from bson.binary import Binary, BinaryVectorDtype
+from pymongo.errors import BulkWriteError, ConnectionFailure, OperationFailure
+from utils import load_config, print_progress, decode_vector
 
+# 每批上傳的文件數
+INSERT_BATCH_SIZE = 500
 
-def create_vector_search_index(collection, index_name, vector_dimension=1536):
+# 記錄向量索引已確認存在，下次上傳可跳過 list_search_indexes() 查詢
+INDEX_READY_FLAG = '.vector_index_ready'
+
+
+# 整個行程共用一個 MongoClient（內建連線池），避免重複連線
+_client = None
+
+
+def _get_client(connection_string):
+    """取得共用的 MongoClient，第一次呼叫時才建立"""
+    global _client
+    if _client is None:
+        _client = MongoClient(connection_string, maxPoolSize=10)
+        atexit.register(_client.close)
+    return _client
+
+
+def _iter_batches(json_file, batch_size=INSERT_BATCH_SIZE):
+    """串流讀取 JSON 陣列，每次產生一批文件（記憶體用量只與批次大小有關）"""
+    batch = []
+    with open(json_file, 'rb') as f:
+        for doc in ijson.items(f, 'item', use_float=True):
+            # 以 BSON 二進位 float32 向量儲存，比 double 陣列小一半
+            doc['vector'] = Binary.from_vector(decode_vector(doc['vector']).tolist(),
+                                               BinaryVectorDtype.FLOAT32)
+            batch.append(doc)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+    if batch:
+        yield batch
+
+
+def create_vector_search_index(collection, index_name, vector_dimension=1536, connection_string=''):
     """創建向量搜尋索引
     
     Args:
         collection: MongoDB collection
         index_name: 索引名稱
         vector_dimension: 向量維度
+        connection_string: 連接字串，用來區分不同叢集（只存雜湊，不會寫出帳密）
     """
     # MongoDB Atlas Vector Search 索引定義
     index_definition = {
@@ -27,12 +70,22 @@ def create_vector_search_index(collection, index_name, vector_dimension=1536):
                     "type": "vector",
                     "path": "vector",
                     "numDimensions": vector_dimension,
-                    "similarity": "cosine"
+                    "similarity": "cosine",
+                    "quantization": "scalar"
                 }
             ]
         }
     }
     
+    # 叢集、集合、索引名稱或向量維度改變時，標記內容就對不上，會重新檢查
+    cluster = hashlib.sha256(connection_string.encode('utf-8')).hexdigest()[:16]
+    signature = f"{cluster}:{collection.full_name}:{index_name}:{vector_dimension}"
+    if os.path.exists(INDEX_READY_FLAG):
+        with open(INDEX_READY_FLAG, 'r', encoding='utf-8') as f:
+            if f.read().strip() == signature:
+                print(f"✓ 向量搜尋索引 '{index_name}' 已存在")
+                return
+    
     try:
         # 檢查索引是否已存在
         existing_indexes = list(collection.list_search_indexes())
@@ -44,12 +97,32 @@ def create_vector_search_index(collection, index_name, vector_dimension=1536):
             print("  注意：索引可能需要幾分鐘才能完全建立")
         else:
             print(f"✓ 向量搜尋索引 '{index_name}' 已存在")
+        
+        with open(INDEX_READY_FLAG, 'w', encoding='utf-8') as f:
+            f.write(signature)
             
     except Exception as e:
         print(f"創建索引時發生錯誤: {e}")
         print("請確認您的 MongoDB Atlas 方案支援 Vector Search（需要 M10 以上）")
 
 
+def _collection_stats(collection):
+    """一次 $facet 聚合取得 (總文件數, 原始檔案數, 分片檔案數)，只需一個來回"""
+    count = [{"$count": "c"}]
+    result = next(collection.aggregate([
+        {
+            "$facet": {
+                "total": count,
+                "primary": [{"$match": {"is_primary": True}}] + count,
+                "multi": [{"$match": {"total_parts": {"$gt": 1}, "is_primary": True}}] + count
+            }
+        }
+    ]), {})
+    # 沒有符合的文件時，$count 會回傳空陣列
+    return tuple(result[key][0]['c'] if result.get(key) else 0
+                 for key in ('total', 'primary', 'multi'))
+
+
 def upload_to_mongodb(json_file='extracted_data.json'):
     """上傳資料到 MongoDB Atlas
     
@@ -74,7 +147,7 @@ def upload_to_mongodb(json_file='extracted_data.json'):
     
     try:
         # 連接 MongoDB
-        client = MongoClient(connection_string)
+        client = _get_client(connection_string)
         
         # 測試連接
         client.admin.command('ping')
@@ -84,37 +157,41 @@ def upload_to_mongodb(json_file='extracted_data.json'):
         db = client[database_name]
         collection = db[collection_name]
         
-        # 載入資料
-        print_progress(f"載入資料從 {json_file}", verbose)
-        with open(json_file, 'r', encoding='utf-8') as f:
-            data = json.load(f)
-        
-        print(f"準備上傳 {len(data)} 筆資料")
-        
         # 清空現有資料（可選）
         response = input("是否清空現有資料？(y/N): ")
         if response.lower() == 'y':
             result = collection.delete_many({})
             print(f"已刪除 {result.deleted_count} 筆舊資料")
         
-        # 插入資料
-        print_progress("上傳資料到 MongoDB...", verbose)
+        # 串流載入並插入資料
+        print_progress(f"從 {json_file} 串流上傳資料到 MongoDB...", verbose)
         
-        if len(data) > 0:
-            result = collection.insert_many(data)
-            print(f"✓ 成功上傳 {len(result.inserted_ids)} 筆資料")
-        else:
+        # 分批、無序插入：單筆失敗不會中斷整批，也不必一次編碼全部向量
+        writer = collection.with_options(write_concern=WriteConcern(w=1, j=False))
+        total = 0
+        inserted = 0
+        for batch in tqdm(_iter_batches(json_file), desc="Uploading", unit="batch"):
+            total += len(batch)
+            try:
+                result = writer.insert_many(batch, ordered=False,
+                                            bypass_document_validation=True)
+                inserted += len(result.inserted_ids)
+            except BulkWriteError as e:
+                # 無序插入時其他文件仍會寫入，只記錄失敗筆數
+                inserted += e.details.get('nInserted', 0)
+                print(f"⚠️  本批有 {len(e.details.get('writeErrors', []))} 筆寫入失敗")
+        
+        if total == 0:
             print("❌ 沒有資料可上傳")
             return False
+        print(f"✓ 成功上傳 {inserted}/{total} 筆資料")
         
         # 創建向量搜尋索引
         print_progress("設定向量搜尋索引...", verbose)
-        create_vector_search_index(collection, index_name)
+        create_vector_search_index(collection, index_name, connection_string=connection_string)
         
         # 顯示統計
-        total_docs = collection.count_documents({})
-        primary_docs = collection.count_documents({"is_primary": True})
-        multi_part_docs = collection.count_documents({"total_parts": {"$gt": 1}, "is_primary": True})
+        total_docs, primary_docs, multi_part_docs = _collection_stats(collection)
         
         print(f"\n資料庫統計:")
         print(f"  - 總文件數: {total_docs}")
@@ -146,14 +223,11 @@ def upload_to_mongodb(json_file='extracted_data.json'):
         import traceback
         traceback.print_exc()
         return False
-    
-    finally:
-        if 'client' in locals():
-            client.close()
-            print_progress("MongoDB 連接已關閉", verbose)
 
 
 if __name__ == '__main__':
+    # utils 的訊息改用 logging 輸出，這裡決定等級（要看 [DEBUG] 訊息時改成 logging.DEBUG）
+    logging.basicConfig(level=logging.INFO, format='%(message)s', stream=sys.stdout)
     success = upload_to_mongodb()
     if not success:
         exit(1)
\ No newline at end of file
@@ -1,131 +1,542 @@
 import requests
+from requests.adapters import HTTPAdapter
+import aiohttp
+import asyncio
 import json
+import logging
+import orjson
 import configparser
 import os
 import re
+import base64
+import collections
+import functools
+import hashlib
+import random
+import time
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import numpy as np
+from cachetools import LRUCache
+
+# 由執行的程式（main.py 等）決定輸出等級與格式；單獨 import 時不輸出
+logger = logging.getLogger(__name__)
+logger.addHandler(logging.NullHandler())
+
+# 程式所在目錄（不是執行目錄）
+_BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+# 已確認存在的資料夾
+_folders_initialized = set()
+
+# Azure embeddings API 單一請求的 input 陣列上限
+EMBEDDING_BATCH_SIZE = 2048
+
+# Azure embedding 模型單段輸入的 token 上限（cl100k_base 編碼）
+EMBEDDING_MAX_TOKENS = 8191
+# 沒有 tiktoken 時改用字數截斷
+EMBEDDING_MAX_CHARS = 8000
+
+# 暫時性錯誤（流量限制、伺服器錯誤）的重試次數與狀態碼
+RETRY_ATTEMPTS = 5
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+# 可以重試的連線階段逾時例外（aiohttp 3.10 起才有 ConnectionTimeoutError）
+_CONNECT_TIMEOUT_ERRORS = tuple(getattr(aiohttp, name) for name in ('ConnectionTimeoutError',)
+                                if hasattr(aiohttp, name))
+
+# 本機向量快取（SQLite），相同文字不必再呼叫 Azure
+EMBEDDING_CACHE_DB = 'embed_cache.sqlite'
+
+# 行程內的 Gemini 回應快取（temperature=0.0，相同 prompt 的結果相同）
+RESPONSE_CACHE_SIZE = 1024
+_response_cache = LRUCache(maxsize=RESPONSE_CACHE_SIZE)
+_response_cache_lock = threading.Lock()
+
+# 預先編譯的正則表達式（型號提取、步驟數、JSON 解析都會反覆用到）
+# 「品名：XXX」格式的型號
+_PINMING_RE = re.compile(r'品名[：:]\s*([A-Za-z]+-?\d+)')
+# 其他常見型號格式：T-323、L-604、BP-27、BP-22 等
+_MODEL_RE = re.compile(r'([A-Za-z]+-\d{2,4})')
+_NUMBER_RE = re.compile(r'\d+')
+# 判斷文字裡有沒有英文字母（型號一定有）
+_ALPHA_RE = re.compile(r'[A-Za-z]')
+# markdown 程式碼區塊標記
+_CODE_FENCE_RE = re.compile(r'```json\s*|\s*```')
+# 從第一個 [ 開始的 JSON 陣列
+_JSON_ARRAY_RE = re.compile(r'\[.*', re.DOTALL)
+
+# prompt 裡每筆 BOM 項目的字數上限
+BOM_ITEM_MAX_CHARS = 200
+
+# 少於這個字數的文字直接當型號，不呼叫 Gemini
+MODEL_HINT_MIN_CHARS = 20
+
+# enhance_bom_text 各路徑的命中次數（regex / 短文字 / 無英文 / gemini）
+_model_hint_stats = collections.Counter()
+
+GEMINI_API_BASE = "https://generativelanguage.googleapis.com/v1beta"
+
+# 分批生成步驟的 prompt：表頭與結尾每批格式化，中間的共用內容整個任務只組一次
+_STEPS_HEADER_TMPL = """你是工廠SOP編輯專家。請參考模板，為新產品生成第 {start} 到第 {end} 步的組裝步驟。
+
+【重要規則】：
+1. 只生成步驟 {start} 到 {end}（共 {count} 個步驟）
+2. 參考模板總共有 {total} 步，請對應生成相應位置的步驟
+3. 保留原本的敘述口吻和細節
+4. 將舊零件名稱替換為新BOM中的零件名稱
+5. 只輸出JSON，不要任何其他文字
+
+"""
+_SHARED_CTX_TMPL = """【新產品 BOM】：
+{input_items}
+
+【參考模板 BOM】：
+{ref_items}
+
+【參考模板內容】：
+{ref_guide}"""
+# 共用內容已放進 context cache 時，用這段說明取代
+_CACHED_CTX_NOTE = "【新產品 BOM】、【參考模板 BOM】與【參考模板內容】已在前文提供。"
+_STEPS_FOOTER_TMPL = """
+
+請輸出 JSON 陣列，格式如下：
+[
+  {{"step_number": {start}, "title": "步驟名稱", "description": "詳細操作說明", "notes": "注意事項"}}
+]"""
+
+# 分批生成步驟的批次大小：預設 8 步，回傳被截斷時減半，最少 2 步
+STEPS_BATCH_SIZE = 8
+STEPS_MIN_BATCH_SIZE = 2
+STEPS_MAX_BATCH_SIZE = 12
+# 一批回傳預計的字數上限（8192 tokens 留些餘裕），配合每步平均字數估算批次大小
+STEPS_OUTPUT_CHAR_BUDGET = 6000
+STEPS_EMA_ALPHA = 0.3
+
+# 同時生成步驟時，Gemini 連線池的連線上限
+GEMINI_MAX_CONNECTIONS = 32
+
+def _retry_delay(attempt, retry_after=None):
+    """指數退避加隨機抖動；429 有 Retry-After 時以它為準"""
+    try:
+        delay = float(retry_after) if retry_after else 2 ** attempt
+    except ValueError:
+        # Retry-After 也可能是 HTTP 日期格式，此時退回指數退避
+        delay = 2 ** attempt
+    return delay + random.random()
+
+def _post_with_retry(session, url, data, headers, timeout):
+    """POST 並在 429 / 5xx / 連線失敗時有限次重試，回傳成功的 response
+
+    讀取逾時不重試：請求可能已送達並開始計費，直接丟給呼叫端處理
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        is_last = attempt == RETRY_ATTEMPTS - 1
+        try:
+            response = session.post(url, data=data, headers=headers, timeout=timeout)
+        except requests.exceptions.ConnectionError as e:
+            # ConnectTimeout 也屬於 ConnectionError；ReadTimeout 不是，會直接往上丟
+            if is_last:
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning("⚠️  連線失敗（%s），%.1f 秒後重試...", type(e).__name__, delay)
+            time.sleep(delay)
+            continue
+        
+        if response.status_code in RETRY_STATUSES and not is_last:
+            delay = _retry_delay(attempt, response.headers.get('Retry-After'))
+            logger.warning("⚠️  HTTP %s，%.1f 秒後重試...", response.status_code, delay)
+            time.sleep(delay)
+            continue
+        
+        response.raise_for_status()
+        return response
+
+async def _read_body(response):
+    return await response.read()
+
+async def _post_with_retry_async(session, url, data, headers, timeout, read=_read_body):
+    """_post_with_retry 的非同步版本，回傳 read(response) 的結果（預設為 response body bytes）
+
+    read 可以逐段讀取串流回應；連線中斷重試時會重新呼叫 read，必須從頭開始讀
+    """
+    for attempt in range(RETRY_ATTEMPTS):
+        is_last = attempt == RETRY_ATTEMPTS - 1
+        try:
+            async with session.post(url, data=data, headers=headers, timeout=timeout) as response:
+                if response.status in RETRY_STATUSES and not is_last:
+                    delay = _retry_delay(attempt, response.headers.get('Retry-After'))
+                    logger.warning("⚠️  HTTP %s，%.1f 秒後重試...", response.status, delay)
+                else:
+                    response.raise_for_status()
+                    return await read(response)
+        except aiohttp.ClientConnectionError as e:
+            # 讀取逾時（ServerTimeoutError 同時是 TimeoutError）不重試，只重試連線階段的失敗
+            if is_last or (isinstance(e, asyncio.TimeoutError) and not isinstance(e, _CONNECT_TIMEOUT_ERRORS)):
+                raise
+            delay = _retry_delay(attempt)
+            logger.warning("⚠️  連線失敗（%s），%.1f 秒後重試...", type(e).__name__, delay)
+        await asyncio.sleep(delay)
+
+def _new_session():
+    """建立有連線池的 requests.Session，重複使用 TCP/TLS 連線"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=8, pool_maxsize=32)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
+
+@dataclass(slots=True, frozen=True)
+class Settings:
+    """API 設定，建立物件時從 config.ini 讀一次，之後直接用屬性存取"""
+    azure_api_key: str
+    azure_endpoint: str
+    azure_api_version: str
+    azure_deployment: str
+    gemini_api_key: str
+    gemini_model: str
+    
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            azure_api_key=config.get('AZURE_OPENAI', 'api_key', fallback=''),
+            azure_endpoint=config.get('AZURE_OPENAI', 'endpoint', fallback=''),
+            azure_api_version=config.get('AZURE_OPENAI', 'api_version', fallback=''),
+            azure_deployment=config.get('AZURE_OPENAI', 'embedding_deployment', fallback=''),
+            gemini_api_key=config.get('GEMINI', 'api_key', fallback=''),
+            gemini_model=config.get('GEMINI', 'model', fallback=''),
+        )
+
+class EmbeddingCache:
+    """以 SHA-256(部署名稱 + 文字) 為鍵、float32 bytes 為值的 SQLite 向量快取"""
+    
+    def __init__(self, db_path=EMBEDDING_CACHE_DB):
+        # autocommit 模式；WAL 讓讀取不會被寫入擋住
+        self.conn = sqlite3.connect(db_path, isolation_level=None, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS emb(k BLOB PRIMARY KEY, v BLOB)")
+        self.lock = threading.Lock()
+    
+    @staticmethod
+    def make_key(deployment, text):
+        return hashlib.sha256(f"{deployment}\0{text}".encode('utf-8')).digest()
+    
+    def get(self, key):
+        """查詢快取，回傳 float32 向量（可寫入的副本），沒有時回傳 None"""
+        with self.lock:
+            row = self.conn.execute("SELECT v FROM emb WHERE k = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+    
+    def put(self, key, vector):
+        with self.lock:
+            self.conn.execute("INSERT OR IGNORE INTO emb(k, v) VALUES (?, ?)",
+                              (key, np.asarray(vector, dtype=np.float32).tobytes()))
 
 class AzureOpenAIAPI:
     """處理 Azure OpenAI Embeddings (向量化)"""
     
     def __init__(self, config_path='config.ini'):
         self.config = load_config(config_path)
+        self.settings = Settings.from_config(self.config)
+        self.cache = EmbeddingCache()
+        self.session = _new_session()
         
-    def get_embedding(self, text):
-        """將文字轉換為向量"""
+    def _clean_input(self, text):
+        """檢查輸入是否有效並整理成可送出的字串，無效時回傳 None"""
         # 檢查輸入是否有效
         if text is None:
-            print("⚠️  [Azure] 輸入文字是 None，跳過")
+            logger.warning("⚠️  [Azure] 輸入文字是 None，跳過")
             return None
         if not isinstance(text, str):
-            print(f"⚠️  [Azure] 輸入不是字串，類型：{type(text)}，跳過")
+            logger.warning("⚠️  [Azure] 輸入不是字串，類型：%s，跳過", type(text))
             return None
         if len(text.strip()) == 0:
-            print("⚠️  [Azure] 輸入文字為空，跳過")
+            logger.warning("⚠️  [Azure] 輸入文字為空，跳過")
             return None
-            
+        
+        # 確保輸入不超過 token 上限
+        return _trim_to_tokens(text.replace("\n", " "), EMBEDDING_MAX_TOKENS)
+    
+    def _embedding_endpoint(self):
+        """組出 embeddings API 的 url 與 headers"""
+        s = self.settings
+        url = f"{s.azure_endpoint}openai/deployments/{s.azure_deployment}/embeddings?api-version={s.azure_api_version}"
+        headers = {"api-key": s.azure_api_key, "Content-Type": "application/json"}
+        return url, headers
+        
+    def get_embeddings(self, texts):
+        """批次將多段文字轉換為 L2 正規化的 float32 向量（每個請求最多 2048 段）
+
+        回傳與 texts 等長、順序相同的 list，無效或失敗的輸入對應 None；
+        成功的向量都是同一個連續 (N, D) 矩陣的列
+        """
+        results = [None] * len(texts)
+        
+        deployment = self.settings.azure_deployment
+        
+        # 只送出有效且快取中沒有的輸入，並記住它們在原始 list 中的位置
+        misses = []
+        for i, text in enumerate(texts):
+            cleaned = self._clean_input(text)
+            if cleaned is None:
+                continue
+            key = EmbeddingCache.make_key(deployment, cleaned)
+            results[i] = self.cache.get(key)
+            if results[i] is None:
+                misses.append((i, cleaned, key))
+        if not misses:
+            return _stack_vectors(results)
+        
+        url, headers = self._embedding_endpoint()
+        
+        for start in range(0, len(misses), EMBEDDING_BATCH_SIZE):
+            batch = misses[start:start + EMBEDDING_BATCH_SIZE]
+            payload = {"input": [text for _, text, _ in batch]}
+            try:
+                response = _post_with_retry(self.session, url, orjson.dumps(payload), headers, timeout=30)
+                # 回傳的 index 對應本批輸入的位置
+                for item in orjson.loads(response.content)['data']:
+                    i, _, key = batch[item['index']]
+                    results[i] = _normalize_vector(item['embedding'])
+                    self.cache.put(key, results[i])
+            except Exception as e:
+                logger.error("❌ [Azure] Embedding Error: %s", e)
+        
+        return _stack_vectors(results)
+        
+    def embed_many(self, texts, workers=16):
+        """把 texts 切成多段，用執行緒同時送出批次請求，回傳格式與 get_embeddings 相同
+
+        每段自帶重試；Session 連線池與 SQLite 快取都可以跨執行緒共用
+        """
+        texts = list(texts)
+        if not texts:
+            return []
+        # 每段至少 1 筆、最多一個請求的上限，盡量平均分給 workers
+        size = min(EMBEDDING_BATCH_SIZE, -(-len(texts) // workers))
+        chunks = [texts[i:i + size] for i in range(0, len(texts), size)]
+        if len(chunks) == 1:
+            return self.get_embeddings(chunks[0])
+        
+        results = []
+        with ThreadPoolExecutor(max_workers=min(workers, len(chunks))) as executor:
+            for part in executor.map(self.get_embeddings, chunks):
+                results.extend(part)
+        return results
+    
+    def get_embedding(self, text):
+        """將文字轉換為 L2 正規化的 float32 向量，失敗時回傳 None"""
+        return self.get_embeddings([text])[0]
+
+    async def get_embedding_async(self, session, text):
+        """get_embedding 的非同步版本，session 為 aiohttp.ClientSession"""
         try:
-            api_key = self.config['AZURE_OPENAI']['api_key']
-            endpoint = self.config['AZURE_OPENAI']['endpoint']
-            api_version = self.config['AZURE_OPENAI']['api_version']
-            deployment = self.config['AZURE_OPENAI']['embedding_deployment']
+            text = self._clean_input(text)
+            if text is None:
+                return None
             
-            url = f"{endpoint}openai/deployments/{deployment}/embeddings?api-version={api_version}"
-            headers = {"api-key": api_key, "Content-Type": "application/json"}
+            key = EmbeddingCache.make_key(self.settings.azure_deployment, text)
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
             
-            # 確保輸入不超過長度限制
-            text = text.replace("\n", " ")[:8000]
+            url, headers = self._embedding_endpoint()
             payload = {"input": text}
             
-            response = requests.post(url, json=payload, headers=headers, timeout=30)
-            response.raise_for_status()
-            return response.json()['data'][0]['embedding']
+            timeout = aiohttp.ClientTimeout(total=30)
+            body = await _post_with_retry_async(session, url, orjson.dumps(payload), headers, timeout)
+            result = orjson.loads(body)
+            vector = _normalize_vector(result['data'][0]['embedding'])
+            self.cache.put(key, vector)
+            return vector
         except Exception as e:
-            print(f"❌ [Azure] Embedding Error: {e}")
+            logger.error("❌ [Azure] Embedding Error: %s", e)
             return None
 
 class GeminiAPI:
     """處理 Gemini 生成與 JSON 解析"""
     
     def __init__(self):
-        config = load_config()
-        self.api_key = config['GEMINI']['api_key']
-        self.model = config['GEMINI']['model']
+        self.settings = Settings.from_config(load_config())
+        self.api_key = self.settings.gemini_api_key
+        self.model = self.settings.gemini_model
+        self.session = _new_session()
+        # 每個步驟平均輸出的字數，用來調整分批大小
+        self._chars_per_step = None
     
-    def generate_text(self, prompt, max_tokens=8192):
-        """呼叫 Gemini 生成內容，已開到最大 8192 tokens"""
-        url = f"https://generativelanguage.googleapis.com/v1beta/models/{self.model}:generateContent?key={self.api_key}"
+    def _generate_request(self, prompt, max_tokens, cached_content=None):
+        """組出 generateContent 請求的 url、headers、payload"""
+        url = f"{GEMINI_API_BASE}/models/{self.model}:generateContent?key={self.api_key}"
         headers = {"Content-Type": "application/json"}
         payload = {
-            "contents": [{"parts": [{"text": prompt}]}],
+            "contents": [{"role": "user", "parts": [{"text": prompt}]}],
             "generationConfig": {
                 "temperature": 0.0, # 絕對零度，確保內容不偏移
                 "maxOutputTokens": max_tokens
             }
         }
+        if cached_content:
+            # 引用事先建立的 context cache，共用的前綴不必每次重送
+            payload["cachedContent"] = cached_content
+        return url, headers, payload
+    
+    def _extract_text(self, result):
+        """從 generateContent 回傳的 JSON 取出文字，格式異常時回傳 None"""
+        # 檢查回傳格式是否正確
+        if 'candidates' not in result:
+            logger.warning("⚠️  [Gemini] 回傳格式異常：沒有 candidates")
+            return None
+        if len(result['candidates']) == 0:
+            logger.warning("⚠️  [Gemini] 回傳格式異常：candidates 為空")
+            return None
         
-        try:
-            response = requests.post(url, json=payload, headers=headers, timeout=120)
-            response.raise_for_status()
-            result = response.json()
-            
-            # 檢查回傳格式是否正確
-            if 'candidates' not in result:
-                print(f"⚠️  [Gemini] 回傳格式異常：沒有 candidates")
-                return None
-            if len(result['candidates']) == 0:
-                print(f"⚠️  [Gemini] 回傳格式異常：candidates 為空")
-                return None
-            
-            candidate = result['candidates'][0]
-            
-            # 檢查是否被安全過濾器擋住
-            if 'content' not in candidate:
-                finish_reason = candidate.get('finishReason', 'UNKNOWN')
-                print(f"⚠️  [Gemini] 內容被過濾，原因：{finish_reason}")
-                return None
-            
-            if 'parts' not in candidate['content']:
-                print(f"⚠️  [Gemini] 回傳格式異常：沒有 parts")
-                return None
+        candidate = result['candidates'][0]
+        
+        # 檢查是否被安全過濾器擋住
+        if 'content' not in candidate:
+            finish_reason = candidate.get('finishReason', 'UNKNOWN')
+            logger.warning("⚠️  [Gemini] 內容被過濾，原因：%s", finish_reason)
+            return None
+        
+        if 'parts' not in candidate['content']:
+            logger.warning("⚠️  [Gemini] 回傳格式異常：沒有 parts")
+            return None
+        
+        if len(candidate['content']['parts']) == 0:
+            logger.warning("⚠️  [Gemini] 回傳格式異常：parts 為空")
+            return None
             
-            if len(candidate['content']['parts']) == 0:
-                print(f"⚠️  [Gemini] 回傳格式異常：parts 為空")
-                return None
-                
-            return candidate['content']['parts'][0]['text']
+        return candidate['content']['parts'][0]['text']
+    
+    def _response_key(self, prompt, max_tokens, cached_content=None):
+        """回應快取的 key：model、prompt、max_tokens、引用的 context cache"""
+        raw = '\0'.join((self.model, prompt, str(max_tokens), cached_content or ''))
+        return hashlib.blake2b(raw.encode('utf-8'), digest_size=16).digest()
+    
+    def _cached_response(self, key):
+        with _response_cache_lock:
+            return _response_cache.get(key)
+    
+    def _store_response(self, key, text):
+        # 失敗（None）不快取，下次還會重新呼叫
+        if text is not None:
+            with _response_cache_lock:
+                _response_cache[key] = text
+        return text
+    
+    def generate_text(self, prompt, max_tokens=8192):
+        """呼叫 Gemini 生成內容，已開到最大 8192 tokens"""
+        key = self._response_key(prompt, max_tokens)
+        cached = self._cached_response(key)
+        if cached is not None:
+            return cached
+        
+        url, headers, payload = self._generate_request(prompt, max_tokens)
+        
+        try:
+            response = _post_with_retry(self.session, url, orjson.dumps(payload), headers, timeout=120)
+            return self._store_response(key, self._extract_text(orjson.loads(response.content)))
         except requests.exceptions.Timeout:
-            print(f"❌ [Gemini] API 超時")
+            logger.error("❌ [Gemini] API 超時")
             return None
         except Exception as e:
-            print(f"❌ [Gemini] API 錯誤: {e}")
+            logger.error("❌ [Gemini] API 錯誤: %s", e)
             return None
 
-    def enhance_bom_text(self, raw_text):
-        """【優化搜尋關鍵】強化提取產品型號"""
+    async def generate_text_async(self, session, prompt, max_tokens=8192, cached_content=None):
+        """generate_text 的非同步版本，session 為 aiohttp.ClientSession"""
+        key = self._response_key(prompt, max_tokens, cached_content)
+        cached = self._cached_response(key)
+        if cached is not None:
+            return cached
+        
+        url, headers, payload = self._generate_request(prompt, max_tokens, cached_content)
+        
+        try:
+            timeout = aiohttp.ClientTimeout(total=120)
+            body = await _post_with_retry_async(session, url, orjson.dumps(payload), headers, timeout)
+            return self._store_response(key, self._extract_text(orjson.loads(body)))
+        except asyncio.TimeoutError:
+            logger.error("❌ [Gemini] API 超時")
+            return None
+        except Exception as e:
+            logger.error("❌ [Gemini] API 錯誤: %s", e)
+            return None
+
+    async def generate_text_stream_async(self, session, prompt, max_tokens=8192, cached_content=None,
+                                         stop_on_json_array=False):
+        """用 streamGenerateContent (SSE) 逐段接收生成內容
+
+        stop_on_json_array=True 時，一收到完整的頂層 JSON 陣列就停止讀取，不必等生成結束
+        """
+        url, headers, payload = self._generate_request(prompt, max_tokens, cached_content)
+        url = f"{GEMINI_API_BASE}/models/{self.model}:streamGenerateContent?alt=sse&key={self.api_key}"
+        
+        async def read_stream(response):
+            parts = []
+            scanner = _JsonArrayScanner()
+            finish_reason = None
+            async for line in response.content:
+                line = line.strip()
+                if not line.startswith(b'data:'):
+                    continue
+                chunk = orjson.loads(line[5:])
+                for candidate in chunk.get('candidates', [])[:1]:
+                    finish_reason = candidate.get('finishReason', finish_reason)
+                    for part in candidate.get('content', {}).get('parts', []):
+                        text = part.get('text', '')
+                        parts.append(text)
+                        scanner.feed(text)
+                if stop_on_json_array and scanner.array_end is not None:
+                    break
+            if not parts:
+                logger.warning("⚠️  [Gemini] 串流沒有回傳內容，原因：%s", finish_reason or 'UNKNOWN')
+                return None
+            return ''.join(parts)
+        
+        try:
+            timeout = aiohttp.ClientTimeout(total=120)
+            return await _post_with_retry_async(session, url, orjson.dumps(payload), headers, timeout,
+                                                read=read_stream)
+        except asyncio.TimeoutError:
+            logger.error("❌ [Gemini] API 超時")
+            return None
+        except Exception as e:
+            logger.error("❌ [Gemini] API 錯誤: %s", e)
+            return None
+
+    def _extract_model_by_regex(self, raw_text):
+        """用正則表達式提取型號；空輸入回傳 ""，找不到回傳 None（需改用 Gemini）"""
         # 如果輸入是空的，直接返回
         if not raw_text or len(raw_text.strip()) == 0:
-            print("⚠️  [enhance_bom_text] 輸入文字為空")
+            logger.warning("⚠️  [enhance_bom_text] 輸入文字為空")
             return ""
         
         # ===== 方法 1：正則表達式直接提取（更可靠）=====
         # 常見型號格式：T-323、L-604、BP-27、BP-22 等
         
         # 嘗試匹配「品名：XXX」格式
-        match = re.search(r'品名[：:]\s*([A-Za-z]+-?\d+)', raw_text)
+        match = _PINMING_RE.search(raw_text)
         if match:
             model = match.group(1)
-            print(f"[DEBUG] 正則表達式提取到型號: {model}")
+            logger.debug("[DEBUG] 正則表達式提取到型號: %s", model)
             return model
         
         # 嘗試匹配其他常見格式
-        match = re.search(r'([A-Za-z]+-\d{2,4})', raw_text)
+        match = _MODEL_RE.search(raw_text)
         if match:
             model = match.group(1)
-            print(f"[DEBUG] 正則表達式提取到型號: {model}")
+            logger.debug("[DEBUG] 正則表達式提取到型號: %s", model)
             return model
         
-        # ===== 方法 2：用 Gemini 提取（備用）=====
-        prompt = f"""你是一位工業 BOM 資料分析師。請從以下原始文字中提取出完整的『產品型號(Model Number)』。
+        return None
+    
+    def _model_prompt(self, raw_text):
+        """方法 2：用 Gemini 提取型號（備用）的 prompt"""
+        return f"""你是一位工業 BOM 資料分析師。請從以下原始文字中提取出完整的『產品型號(Model Number)』。
 
 【重要規則】：
 1. 產品型號通常是英文字母+數字的組合，例如：T-323、L-604、BP-27、BP-22
@@ -137,62 +548,154 @@ class GeminiAPI:
 {raw_text[:3000]}
 
 請回答完整的產品型號："""
-        result = self.generate_text(prompt, max_tokens=100)
-        
+    
+    def _finish_model_hint(self, result, raw_text):
+        """整理 Gemini 回傳的型號，回傳 (型號, 是否為 Gemini 的有效結果)"""
         # 如果 Gemini 回傳 None 或太短，返回原始文字的前 100 字作為備用
         if result is None or len(result.strip()) < 2:
-            print("⚠️  [enhance_bom_text] Gemini 無回應，使用原始文字")
-            return raw_text[:100]
+            logger.warning("⚠️  [enhance_bom_text] Gemini 無回應，使用原始文字")
+            return raw_text[:100], False
         
         result = result.strip()
-        print(f"[DEBUG] Gemini 提取到型號: {result}")
+        logger.debug("[DEBUG] Gemini 提取到型號: %s", result)
         
-        return result
+        return result, True
 
-    def generate_assembly_steps(self, input_bom, reference_bom):
-        """核心：分批呼叫 LLM 生成完整組裝步驟"""
-        
-        input_items = "\n".join([f"{i.get('number','')} {i.get('full_text','')}" for i in input_bom.get('bom_items', [])])
-        ref_items = "\n".join([f"{i.get('number','')} {i.get('full_text','')}" for i in reference_bom.get('bom_items', [])])
-        ref_guide = reference_bom.get('full_text', '無參考內容')
+    def _quick_model_hint(self, raw_text):
+        """不呼叫 Gemini 就能決定的型號；回傳 None 表示需要 Gemini"""
+        model = self._extract_model_by_regex(raw_text)
+        if model is not None:
+            path = 'regex'
+        elif len(raw_text) < MODEL_HINT_MIN_CHARS:
+            # 太短，Gemini 也問不出更多
+            path, model = 'short', raw_text.strip()
+        elif not _ALPHA_RE.search(raw_text):
+            # 沒有英文字母就不會有型號
+            path, model = 'no_alpha', raw_text[:100]
+        else:
+            path = 'gemini'
         
-        # ===== 第 1 步：判斷總共需要幾個步驟 =====
-        print("[INFO] 第 1 次呼叫 LLM：分析參考模板，判斷總步驟數...")
-        total_steps = self._get_total_steps(ref_guide)
+        _model_hint_stats[path] += 1
+        total = sum(_model_hint_stats.values())
+        logger.debug("[DEBUG] 型號提取路徑: %s（免呼叫 Gemini %s/%s）",
+                     path, total - _model_hint_stats['gemini'], total)
+        return model
+
+    def enhance_bom_text(self, raw_text):
+        """【優化搜尋關鍵】強化提取產品型號"""
+        model = self._quick_model_hint(raw_text)
+        if model is not None:
+            return model
         
-        if total_steps is None or total_steps < 1:
-            print("⚠️  無法判斷步驟數，預設為 13 步")
-            total_steps = 13
+        result = self.generate_text(self._model_prompt(raw_text), max_tokens=100)
+        return self._finish_model_hint(result, raw_text)[0]
+
+    async def enhance_bom_text_async(self, session, raw_text):
+        """enhance_bom_text 的非同步版本，session 為 aiohttp.ClientSession"""
+        return (await self.model_hint_async(session, raw_text))[0]
+
+    async def model_hint_async(self, session, raw_text):
+        """同 enhance_bom_text_async，但回傳 (型號, 是否可靠)
+
+        Gemini 失敗時改用原始文字當備用，這時「是否可靠」為 False，呼叫端不應快取
+        """
+        model = self._quick_model_hint(raw_text)
+        if model is not None:
+            return model, True
         
-        print(f"✅ 判斷出需要生成 {total_steps} 個步驟")
+        result = await self.generate_text_async(session, self._model_prompt(raw_text), max_tokens=100)
+        return self._finish_model_hint(result, raw_text)
+
+    def generate_assembly_steps(self, input_bom, reference_bom):
+        """核心：分批呼叫 LLM 生成完整組裝步驟（各批次同時送出）"""
+        return asyncio.run(self.generate_assembly_steps_async(input_bom, reference_bom))
+
+    async def generate_assembly_steps_async(self, input_bom, reference_bom):
+        """generate_assembly_steps 的非同步版本"""
         
-        # ===== 第 2 步：分批生成步驟（每批 4 個）=====
-        all_steps = []
-        batch_size = 4
-        batch_num = 1
+        input_items = _format_bom_items(input_bom)
+        ref_items = _format_bom_items(reference_bom)
+        ref_guide = reference_bom.get('full_text', '無參考內容')
         
-        for start in range(1, total_steps + 1, batch_size):
-            end = min(start + batch_size - 1, total_steps)
+        # 整個任務共用同一個連線池
+        connector = aiohttp.TCPConnector(limit=GEMINI_MAX_CONNECTIONS)
+        async with aiohttp.ClientSession(connector=connector) as session:
+            # ===== 第 1 步：判斷總共需要幾個步驟 =====
+            logger.info("[INFO] 第 1 次呼叫 LLM：分析參考模板，判斷總步驟數...")
+            total_steps = await self._get_total_steps_async(session, ref_guide)
             
-            print(f"[INFO] 第 {batch_num + 1} 次呼叫 LLM：生成步驟 {start}-{end}...")
+            if total_steps is None or total_steps < 1:
+                logger.warning("⚠️  無法判斷步驟數，預設為 13 步")
+                total_steps = 13
             
-            batch_steps = self._generate_steps_batch(
-                input_items, ref_items, ref_guide, 
-                start, end, total_steps
-            )
+            logger.info("✅ 判斷出需要生成 %s 個步驟", total_steps)
             
-            if batch_steps:
-                all_steps.extend(batch_steps)
-                print(f"✅ 成功生成步驟 {start}-{end}（本批 {len(batch_steps)} 個）")
-            else:
-                print(f"⚠️  步驟 {start}-{end} 生成失敗，跳過")
+            # ===== 第 2 步：分批生成步驟（同一輪的批次同時呼叫，缺漏的步驟縮小批次重試）=====
+            # 每一批共用的 BOM 與參考模板內容，放進 Gemini context cache 只送一次
+            shared_ctx = _SHARED_CTX_TMPL.format(input_items=input_items, ref_items=ref_items, ref_guide=ref_guide)
+            cache_name = await self._create_context_cache(session, shared_ctx)
             
-            batch_num += 1
+            steps_by_number = {}
+            pending = list(range(1, total_steps + 1))
+            batch_size = self._steps_batch_size()
+            try:
+                while pending:
+                    ranges = _split_step_ranges(pending, batch_size)
+                    logger.info("[INFO] 同時呼叫 LLM 生成 %s 批步驟（每批最多 %s 步）...", len(ranges), batch_size)
+                    
+                    results = await asyncio.gather(*[
+                        self._generate_steps_batch_async(
+                            session, shared_ctx, start, end, total_steps, cache_name
+                        )
+                        for start, end in ranges
+                    ])
+                    
+                    short = False
+                    for (start, end), batch_steps in zip(ranges, results):
+                        got = _collect_batch_steps(batch_steps, start, end)
+                        steps_by_number.update(got)
+                        if len(got) == end - start + 1:
+                            logger.info("✅ 成功生成步驟 %s-%s（本批 %s 個）", start, end, len(got))
+                            self._update_chars_per_step(batch_steps)
+                        else:
+                            short = True
+                            logger.warning("⚠️  步驟 %s-%s 只拿到 %s 個", start, end, len(got))
+                    
+                    pending = [n for n in pending if n not in steps_by_number]
+                    if not pending:
+                        break
+                    if not short or batch_size <= STEPS_MIN_BATCH_SIZE:
+                        # 已經是最小批次還是缺，不再重試
+                        logger.warning("⚠️  步驟 %s 生成失敗，跳過", ', '.join(map(str, pending)))
+                        break
+                    # 回傳被截斷或缺步驟：批次減半再補缺的部分
+                    batch_size = max(STEPS_MIN_BATCH_SIZE, batch_size // 2)
+            finally:
+                if cache_name:
+                    await self._delete_context_cache(session, cache_name)
+        
+        # 依步驟編號組合結果
+        all_steps = [steps_by_number[n] for n in sorted(steps_by_number)]
         
-        print(f"\n🎉 全部完成！共生成 {len(all_steps)} 個步驟")
+        logger.info("\n🎉 全部完成！共生成 %s 個步驟", len(all_steps))
         return all_steps
     
-    def _get_total_steps(self, ref_guide):
+    def _steps_batch_size(self):
+        """依過去每步驟的平均輸出字數估算一批能放幾步，沒有紀錄時用預設值"""
+        if not self._chars_per_step:
+            return STEPS_BATCH_SIZE
+        fit = int(STEPS_OUTPUT_CHAR_BUDGET / self._chars_per_step)
+        return max(STEPS_MIN_BATCH_SIZE, min(STEPS_MAX_BATCH_SIZE, fit))
+    
+    def _update_chars_per_step(self, batch_steps):
+        """用完整批次的輸出更新每步驟平均字數（指數移動平均）"""
+        chars = len(orjson.dumps(batch_steps).decode('utf-8')) / len(batch_steps)
+        if self._chars_per_step is None:
+            self._chars_per_step = chars
+        else:
+            self._chars_per_step += STEPS_EMA_ALPHA * (chars - self._chars_per_step)
+    
+    async def _get_total_steps_async(self, session, ref_guide):
         """第一次呼叫：判斷參考模板總共有幾個步驟"""
         prompt = f"""你是工廠SOP分析專家。請分析以下參考模板內容，判斷總共有幾個組裝步驟。
 
@@ -202,50 +705,65 @@ class GeminiAPI:
 請只回覆一個數字，例如：13
 不要有任何其他文字。"""
         
-        response = self.generate_text(prompt, max_tokens=50)
+        response = await self.generate_text_async(session, prompt, max_tokens=50)
         
         if response:
             # 提取數字
-            match = re.search(r'\d+', response)
+            match = _NUMBER_RE.search(response)
             if match:
                 return int(match.group())
         return None
     
-    def _generate_steps_batch(self, input_items, ref_items, ref_guide, start, end, total):
-        """分批生成步驟"""
-        prompt = f"""你是工廠SOP編輯專家。請參考模板，為新產品生成第 {start} 到第 {end} 步的組裝步驟。
-
-【重要規則】：
-1. 只生成步驟 {start} 到 {end}（共 {end - start + 1} 個步驟）
-2. 參考模板總共有 {total} 步，請對應生成相應位置的步驟
-3. 保留原本的敘述口吻和細節
-4. 將舊零件名稱替換為新BOM中的零件名稱
-5. 只輸出JSON，不要任何其他文字
-
-【新產品 BOM】：
-{input_items}
-
-【參考模板 BOM】：
-{ref_items}
-
-【參考模板內容】：
-{ref_guide}
-
-請輸出 JSON 陣列，格式如下：
-[
-  {{"step_number": {start}, "title": "步驟名稱", "description": "詳細操作說明", "notes": "注意事項"}}
-]"""
+    async def _create_context_cache(self, session, shared_text, ttl='300s'):
+        """建立 Gemini context cache，回傳 cache 名稱；內容太短或建立失敗時回傳 None"""
+        url = f"{GEMINI_API_BASE}/cachedContents?key={self.api_key}"
+        payload = {
+            "model": f"models/{self.model}",
+            "contents": [{"role": "user", "parts": [{"text": shared_text}]}],
+            "ttl": ttl
+        }
+        try:
+            headers = {"Content-Type": "application/json"}
+            async with session.post(url, data=orjson.dumps(payload), headers=headers,
+                                    timeout=aiohttp.ClientTimeout(total=60)) as response:
+                if response.status != 200:
+                    # 內容低於模型的最小快取 token 數時會被拒絕，改為每批直接附上內容
+                    logger.info("[INFO] 未使用 context cache（HTTP %s），改為每批附上完整內容", response.status)
+                    return None
+                result = orjson.loads(await response.read())
+            logger.info("[INFO] 已建立 context cache: %s", result['name'])
+            return result['name']
+        except Exception as e:
+            logger.warning("⚠️  [Gemini] 建立 context cache 失敗，改為每批附上完整內容: %s", e)
+            return None
+    
+    async def _delete_context_cache(self, session, cache_name):
+        """刪除 context cache（失敗也沒關係，TTL 到期會自動清除）"""
+        url = f"{GEMINI_API_BASE}/{cache_name}?key={self.api_key}"
+        try:
+            async with session.delete(url, timeout=aiohttp.ClientTimeout(total=30)):
+                pass
+        except Exception as e:
+            logger.warning("⚠️  [Gemini] 刪除 context cache 失敗: %s", e)
+    
+    async def _generate_steps_batch_async(self, session, shared_ctx, start, end, total, cache_name=None):
+        """分批生成步驟；有 cache_name 時共用內容已在 context cache 中，prompt 不再重複附上"""
+        # 只有表頭與結尾需要每批格式化，共用內容直接串接
+        context = _CACHED_CTX_NOTE if cache_name else shared_ctx
+        prompt = (_STEPS_HEADER_TMPL.format(start=start, end=end, total=total, count=end - start + 1)
+                  + context
+                  + _STEPS_FOOTER_TMPL.format(start=start))
         
-        response = self.generate_text(prompt)
+        # 串流接收，JSON 陣列一完整就開始解析
+        response = await self.generate_text_stream_async(session, prompt, cached_content=cache_name,
+                                                         stop_on_json_array=True)
         
-        # DEBUG 輸出
-        print(f"\n{'='*40}")
-        print(f"🔍 [DEBUG] 步驟 {start}-{end} 的 Gemini 回傳：")
-        print(f"{'='*40}")
-        if response:
+        # DEBUG 輸出（只有開啟 DEBUG 等級時才切字串、組訊息）
+        if logger.isEnabledFor(logging.DEBUG):
             # 只印前 500 字，避免太長
-            print(response[:500] + "..." if len(response) > 500 else response)
-        print(f"{'='*40}\n")
+            preview = response[:500] + "..." if response and len(response) > 500 else response
+            logger.debug("\n%s\n🔍 [DEBUG] 步驟 %s-%s 的 Gemini 回傳：\n%s\n%s\n%s\n",
+                         '=' * 40, start, end, '=' * 40, preview or '', '=' * 40)
         
         return self._parse_json_safely(response)
 
@@ -253,76 +771,165 @@ class GeminiAPI:
         """強化版 JSON 解析（含自動修復被截斷的 JSON）"""
         # ===== DEBUG: 檢查輸入 =====
         if text is None:
-            print("❌ [DEBUG] Gemini 回傳是 None，可能是 API 呼叫失敗")
+            logger.error("❌ [DEBUG] Gemini 回傳是 None，可能是 API 呼叫失敗")
             return None
         # ===== DEBUG END =====
         
         try:
             # 移除 markdown 程式碼區塊標記
-            cleaned = re.sub(r'```json\s*|\s*```', '', text).strip()
+            cleaned = _CODE_FENCE_RE.sub('', text).strip()
             
             # 嘗試找到 JSON 陣列
-            match = re.search(r'\[.*', cleaned, re.DOTALL)
+            match = _JSON_ARRAY_RE.search(cleaned)
             if match:
                 cleaned = match.group(0)
             
             # 第一次嘗試：直接解析
             try:
-                return json.loads(cleaned)
-            except json.JSONDecodeError:
-                pass
+                return orjson.loads(cleaned)
+            except orjson.JSONDecodeError:
+                # orjson 比標準庫嚴格（例如不接受 NaN），再用 json 試一次
+                try:
+                    return json.loads(cleaned)
+                except json.JSONDecodeError:
+                    pass
             
             # ===== 自動修復被截斷的 JSON =====
-            print("⚠️  [DEBUG] JSON 可能被截斷，嘗試自動修復...")
+            logger.warning("⚠️  [DEBUG] JSON 可能被截斷，嘗試自動修復...")
             
-            # 找到最後一個完整的物件（以 }, 或 } 結尾）
-            # 策略：找到最後一個 "notes": "..." } 的位置
-            last_complete = re.findall(r'\{[^{}]*"notes"\s*:\s*"[^"]*"\s*\}', cleaned, re.DOTALL)
+            # 找到陣列中最後一個完整物件的結束位置
+            last_pos = _last_complete_object_end(cleaned)
             
-            if last_complete:
-                # 找到最後一個完整物件的結束位置
-                last_obj = last_complete[-1]
-                last_pos = cleaned.rfind(last_obj) + len(last_obj)
-                
+            if last_pos is not None:
                 # 截取到最後一個完整物件，並加上 ]
                 fixed = cleaned[:last_pos] + ']'
                 
                 try:
-                    result = json.loads(fixed)
-                    print(f"✅ [DEBUG] 自動修復成功！已解析 {len(result)} 個步驟")
+                    result = orjson.loads(fixed)
+                    logger.debug("✅ [DEBUG] 自動修復成功！已解析 %s 個步驟", len(result))
                     return result
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     pass
             
             # 備用策略：暴力修復，補上可能缺少的 }, ]
             for suffix in [']', '}]', '"}]', '""}]', '":""}]']:
                 try:
-                    result = json.loads(cleaned + suffix)
-                    print(f"✅ [DEBUG] 備用修復成功！已解析 {len(result)} 個步驟")
+                    result = orjson.loads(cleaned + suffix)
+                    logger.debug("✅ [DEBUG] 備用修復成功！已解析 %s 個步驟", len(result))
                     return result
-                except json.JSONDecodeError:
+                except orjson.JSONDecodeError:
                     continue
             
-            print(f"❌ [JSON Parse Error] 無法修復被截斷的 JSON")
+            logger.error("❌ [JSON Parse Error] 無法修復被截斷的 JSON")
             return None
             
         except Exception as e:
-            print(f"❌ [JSON Parse Error] AI 回傳格式不對。")
-            print(f"❌ [DEBUG] 錯誤詳情: {e}")
+            logger.error("❌ [JSON Parse Error] AI 回傳格式不對。")
+            logger.error("❌ [DEBUG] 錯誤詳情: %s", e)
             return None
 
-def load_config(config_path='config.ini'):
-    """載入設定檔，並確保資料夾存在"""
-    import os
+class _JsonArrayScanner:
+    """逐字掃描 JSON 陣列的括號深度（可分段餵入），略過字串內的括號與跳脫字元
+
+    last_object_end：最後一個完整頂層物件結尾的下一個位置
+    array_end：頂層陣列的 ] 結尾的下一個位置（陣列還沒結束時為 None）
+    """
     
-    # 取得程式所在目錄（不是執行目錄）
-    base_dir = os.path.dirname(os.path.abspath(__file__))
-    config_full_path = os.path.join(base_dir, config_path)
+    def __init__(self):
+        self.pos = 0
+        self.depth = 0
+        self.started = False
+        self.in_string = False
+        self.escape = False
+        self.last_object_end = None
+        self.array_end = None
+    
+    def feed(self, text):
+        for ch in text:
+            self.pos += 1
+            if self.array_end is not None:
+                continue
+            if not self.started:
+                # 第一個 [ 之前的內容（例如 ```json）不計
+                if ch == '[':
+                    self.started = True
+                    self.depth = 1
+                continue
+            if self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif ch == '\\':
+                    self.escape = True
+                elif ch == '"':
+                    self.in_string = False
+            elif ch == '"':
+                self.in_string = True
+            elif ch in '[{':
+                self.depth += 1
+            elif ch in ']}':
+                self.depth -= 1
+                # 從深度 2 回到 1：剛結束一個陣列裡的頂層物件
+                if ch == '}' and self.depth == 1:
+                    self.last_object_end = self.pos
+                elif self.depth == 0:
+                    self.array_end = self.pos
+        return self
+
+def _split_step_ranges(numbers, batch_size):
+    """把待生成的步驟編號切成連續區間 (start, end)，每段最多 batch_size 步"""
+    ranges = []
+    for n in numbers:
+        if ranges and n == ranges[-1][1] + 1 and n - ranges[-1][0] < batch_size:
+            ranges[-1] = (ranges[-1][0], n)
+        else:
+            ranges.append((n, n))
+    return ranges
+
+def _collect_batch_steps(batch_steps, start, end):
+    """整理一批回傳，回傳 {步驟編號: 步驟}；沒有合法 step_number 的依順序補上編號"""
+    got = {}
+    if not isinstance(batch_steps, list):
+        return got
+    for offset, step in enumerate(batch_steps):
+        if not isinstance(step, dict):
+            continue
+        number = step.get('step_number')
+        if not isinstance(number, int):
+            number = start + offset
+            step['step_number'] = number
+        if start <= number <= end:
+            got.setdefault(number, step)
+    return got
+
+def _format_bom_items(bom):
+    """把 BOM 項目排成「編號 內容」一行一筆，略過空白項目，過長的行截斷以免灌大 prompt"""
+    lines = []
+    for item in bom.get('bom_items', ()):
+        text = (item.get('full_text') or '').strip()
+        if text:
+            lines.append(f"{item.get('number') or ''} {text}"[:BOM_ITEM_MAX_CHARS])
+    return "\n".join(lines)
+
+def _last_complete_object_end(text):
+    """線性掃描 JSON 陣列，回傳最後一個完整頂層物件結尾的下一個位置，找不到時回傳 None
+
+    會略過字串內的括號與跳脫字元，所以描述文字裡出現 { } 也不會誤判
+    """
+    return _JsonArrayScanner().feed(text).last_object_end
+
+def load_config(config_path='config.ini'):
+    """載入設定檔，並確保資料夾存在（同一個設定檔只解析一次）"""
+    config_full_path = os.path.join(_BASE_DIR, config_path)
     
     # 如果在程式目錄找不到，就在當前目錄找
     if not os.path.exists(config_full_path):
         config_full_path = config_path
     
+    return _load_config_file(os.path.abspath(config_full_path))
+
+@functools.lru_cache(maxsize=8)
+def _load_config_file(config_full_path):
+    """實際解析設定檔；以絕對路徑快取，回傳的物件由所有呼叫端共用，請勿修改"""
     config = configparser.ConfigParser()
     config.read(config_full_path, encoding='utf-8')
     
@@ -332,15 +939,82 @@ def load_config(config_path='config.ini'):
             path = config['PATHS'][key]
             # 如果是相對路徑，轉換成絕對路徑
             if path.startswith('./'):
-                path = os.path.join(base_dir, path[2:])
+                path = os.path.join(_BASE_DIR, path[2:])
                 config['PATHS'][key] = path
-            # 建立資料夾（如果不存在）
-            if 'folder' in key and not os.path.exists(path):
-                os.makedirs(path, exist_ok=True)
-                print(f"[INFO] 自動建立資料夾: {path}")
+            # 建立資料夾（如果不存在），每個路徑只檢查一次
+            if 'folder' in key and path not in _folders_initialized:
+                _folders_initialized.add(path)
+                if not os.path.exists(path):
+                    os.makedirs(path, exist_ok=True)
+                    logger.info("[INFO] 自動建立資料夾: %s", path)
     
     return config
 
 def print_progress(message, verbose=True):
     if verbose:
-        print(f"[INFO] {message}")
\ No newline at end of file
+        print(f"[INFO] {message}")
+
+@functools.lru_cache(maxsize=1)
+def _get_encoder():
+    """取得 cl100k_base tokenizer（第一次用到才載入）；無法使用 tiktoken 時回傳 None"""
+    try:
+        import tiktoken
+        return tiktoken.get_encoding('cl100k_base')
+    except ImportError:
+        logger.warning("⚠️  未安裝 tiktoken，改用字數截斷 embedding 輸入")
+    except Exception as e:
+        # 第一次使用需要下載編碼表，離線時會失敗
+        logger.warning("⚠️  無法載入 tiktoken 編碼表（%s），改用字數截斷 embedding 輸入", e)
+    return None
+
+def _trim_to_tokens(text, max_tokens):
+    """把文字截到 max_tokens 個 token 以內"""
+    # 每個 token 至少對應 1 個 UTF-8 byte，bytes 數不超過上限就不可能超過，免去編碼
+    if len(text) * 4 <= max_tokens or len(text.encode('utf-8')) <= max_tokens:
+        return text
+    encoder = _get_encoder()
+    if encoder is None:
+        return text[:EMBEDDING_MAX_CHARS]
+    tokens = encoder.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoder.decode(tokens[:max_tokens])
+
+def _normalize_vector(vector):
+    """轉成 float32 並做 L2 正規化，之後算 cosine 相似度只要內積"""
+    arr = np.asarray(vector, dtype=np.float32)
+    return arr / (np.linalg.norm(arr) + 1e-12)
+
+def _stack_vectors(vectors):
+    """把 list 中非 None 的向量放進同一個連續矩陣，回傳各列的 view（None 保留）"""
+    rows = [i for i, v in enumerate(vectors) if v is not None]
+    if not rows:
+        return vectors
+    matrix = np.vstack([vectors[i] for i in rows])
+    for row, i in enumerate(rows):
+        vectors[i] = matrix[row]
+    return vectors
+
+def cosine_topk(query, matrix, k):
+    """向量都已 L2 正規化時，用一次矩陣乘法算出 cosine 相似度最高的 k 筆
+
+    回傳 (索引, 分數)，依分數由高到低排序
+    """
+    scores = np.asarray(matrix, dtype=np.float32) @ np.asarray(query, dtype=np.float32)
+    k = min(k, len(scores))
+    if k <= 0:
+        return np.empty(0, dtype=np.intp), np.empty(0, dtype=np.float32)
+    # 先用 argpartition 挑出前 k 名（O(n)），只排序這 k 筆
+    idx = np.argpartition(-scores, k - 1)[:k]
+    idx = idx[np.argsort(-scores[idx])]
+    return idx, scores[idx]
+
+def encode_vector(vector):
+    """把向量壓成 float32 bytes 再轉 base64 字串（比 JSON 浮點數陣列小約 4 倍）"""
+    return base64.b64encode(np.asarray(vector, dtype=np.float32).tobytes()).decode('ascii')
+
+def decode_vector(value):
+    """還原 encode_vector 的結果；舊版資料是浮點數陣列，也一併支援"""
+    if isinstance(value, str):
+        return np.frombuffer(base64.b64decode(value), dtype=np.float32)
+    return np.asarray(value, dtype=np.float32)